@@ -1,64 +1,274 @@
+import asyncio
 import datetime
-import bs4
+import aiohttp
+import httpx
+import importlib.util
 import logging
-import requests
+import orjson
+import os
+import time
+from itertools import chain, islice, repeat, zip_longest
+from lxml import html
 
 # Use the custom logger
 logger = logging.getLogger('snow_forecast_logger')
 
+# Ask for Brotli-compressed pages only when the brotli package is there to decode them
+if importlib.util.find_spec('brotli') is not None:
+    _ACCEPT_ENCODING = 'gzip, deflate, br'
+else:
+    _ACCEPT_ENCODING = 'gzip, deflate'
+
+# Parsed pages and their validators are kept here between runs
+_HTTP_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'snow-forecast', 'http_cache.json')
+
+# The cache holds parser output, bump this whenever a _parse_* function changes what it returns
+# so results in the old shape are thrown away instead of coming back on every 304
+_HTTP_CACHE_VERSION = 2
+
+# Entries not fetched or revalidated for this long are dropped when the cache is saved
+_HTTP_CACHE_MAX_AGE = 14 * 24 * 3600
+
+# One parser shared by every page, parsing as UTF-8 so lxml does not have to guess the encoding
+_HTML_PARSER = html.HTMLParser(encoding='utf-8')
+
+# The forecast table shows an em dash for "no snow"
+_DASH_FIX = {'—': '0'}
+
+# Shared stand-in for a missing forecast row, zip_longest pads it with None
+_NO_CELLS = ()
+
+def _has_class(class_name):
+    """XPath predicate matching elements whose class list contains class_name"""
+    return f'contains(concat(" ", normalize-space(@class), " "), " {class_name} ")'
+
+def _cache_key(parse, url):
+    """Key of a parsed page in the HTTP cache; the same URL read by two parsers gives two entries"""
+    return f"{parse.__name__} {url}"
+
+def _cell_text(cell):
+    """Text of an element with each text node stripped, like BeautifulSoup's get_text(strip=True)"""
+    if len(cell) == 0:
+        # Most cells hold a single text node, no need to walk descendants
+        return (cell.text or '').strip()
+    return ''.join(text.strip() for text in cell.itertext())
+
 class SnowForecast:
     """Handles only fetching forecast data from the website snow-forecast.com"""
     def __init__(self):
         self.base_url = "https://www.snow-forecast.com"
-        self.headers = {'User-Agent': 'Mozilla/5.0'}
+        self.headers = {'User-Agent': 'Mozilla/5.0', 'Accept-Encoding': _ACCEPT_ENCODING}
+        # All requests of the sync methods go to the same host, so share one HTTP/2 connection pool;
+        # the async methods use the aiohttp session from async_session() instead
+        transport = httpx.HTTPTransport(
+            http2=True,
+            retries=3,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+        )
+        self.session = httpx.Client(transport=transport, headers=self.headers,
+                                    follow_redirects=True, timeout=30.0)
+        # Parsed results of previous GETs with their validators: _cache_key(parse, url) -> {'etag', 'last_modified', 'result'},
+        # loaded from the previous run so unchanged pages come back as 304 and are not parsed again
+        self._http_cache = self._load_http_cache()
+        # Keys stored or revalidated by this instance, only these are written back by close()
+        self._http_cache_updated = set()
+        # Listings already fetched by this instance, they do not change within a run
+        self._countries = None
+        self._resorts_by_country = {}
 
-    def get_countries(self):
-        url = f"{self.base_url}/countries"
-        response = requests.get(url)
+    def close(self):
+        """Close the pooled HTTP connections and save the parsed page cache"""
+        self.session.close()
+        self._save_http_cache()
+
+    def _load_http_cache(self):
+        try:
+            with open(_HTTP_CACHE_FILE, 'rb') as f:
+                cached = orjson.loads(f.read())
+        except FileNotFoundError:
+            return {}
+        except (OSError, orjson.JSONDecodeError) as e:
+            logger.warning(f"Ignoring unreadable HTTP cache {_HTTP_CACHE_FILE}: {e}")
+            return {}
+        if not isinstance(cached, dict) or cached.get('version') != _HTTP_CACHE_VERSION \
+                or not isinstance(cached.get('pages'), dict):
+            logger.info(f"Discarding HTTP cache {_HTTP_CACHE_FILE} written in another format")
+            return {}
+        return cached['pages']
+
+    def _save_http_cache(self):
+        if not self._http_cache_updated:
+            return
+        # Merge into what is on disk now, so entries saved by other instances since this one
+        # was created are kept rather than overwritten with this instance's older copy
+        http_cache = self._load_http_cache()
+        http_cache.update((key, self._http_cache[key]) for key in self._http_cache_updated)
+        # Drop pages no run has asked for recently, so the file does not keep growing
+        cutoff = time.time() - _HTTP_CACHE_MAX_AGE
+        http_cache = {key: entry for key, entry in http_cache.items()
+                      if isinstance(entry, dict) and entry.get('used_at', 0) >= cutoff}
+        try:
+            os.makedirs(os.path.dirname(_HTTP_CACHE_FILE), exist_ok=True)
+            # Write to a temporary file first so an interrupted run cannot leave a truncated cache
+            tmp_file = f"{_HTTP_CACHE_FILE}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(orjson.dumps({'version': _HTTP_CACHE_VERSION, 'pages': http_cache}))
+            os.replace(tmp_file, _HTTP_CACHE_FILE)
+            self._http_cache_updated.clear()
+        except OSError as e:
+            logger.warning(f"Could not save HTTP cache {_HTTP_CACHE_FILE}: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def async_session(self):
+        """Create an aiohttp session for the async methods, to be used as an async context manager"""
+        connector = aiohttp.TCPConnector(limit=16, limit_per_host=8)
+        # Same 30 s limit as the sync client, so a stalled page cannot hold a slot for aiohttp's default 5 minutes
+        timeout = aiohttp.ClientTimeout(total=30)
+        return aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=timeout,
+                                     raise_for_status=True)
+
+    def _conditional_headers(self, cached):
+        headers = {}
+        if cached:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+        return headers
+
+    def _store_parsed(self, key, response_headers, result):
+        etag = response_headers.get('ETag')
+        last_modified = response_headers.get('Last-Modified')
+        if etag or last_modified:
+            self._http_cache[key] = {'etag': etag, 'last_modified': last_modified, 'result': result,
+                                     'used_at': time.time()}
+            self._http_cache_updated.add(key)
+
+    def _revalidated(self, key, url):
+        """Result of a cached page the server answered 304 Not Modified for"""
+        logger.debug(f"Not modified: {url}")
+        cached = self._http_cache[key]
+        cached['used_at'] = time.time()
+        self._http_cache_updated.add(key)
+        return cached['result']
+
+    def _get_parsed(self, url, parse):
+        """
+        GET url and return parse(content).
+
+        A page fetched before is revalidated with If-None-Match / If-Modified-Since,
+        and on 304 Not Modified the previously parsed result is returned without
+        downloading or parsing the page again.
+        """
+        key = _cache_key(parse, url)
+        cached = self._http_cache.get(key)
+        response = self.session.get(url, headers=self._conditional_headers(cached))
+        if cached and response.status_code == 304:
+            return self._revalidated(key, url)
         response.raise_for_status()
-        soup = bs4.BeautifulSoup(response.text, 'html.parser')
+        result = parse(response.content)
+        self._store_parsed(key, response.headers, result)
+        return result
+
+    async def _aget_parsed(self, session, url, parse, executor=None):
+        """Async variant of _get_parsed, session comes from async_session(); parse runs in executor if given"""
+        key = _cache_key(parse, url)
+        cached = self._http_cache.get(key)
+        async with session.get(url, headers=self._conditional_headers(cached)) as response:
+            if cached and response.status == 304:
+                return self._revalidated(key, url)
+            content = await response.read()
+            response_headers = response.headers
+        if executor is None:
+            result = parse(content)
+        else:
+            result = await asyncio.get_running_loop().run_in_executor(executor, parse, content)
+        self._store_parsed(key, response_headers, result)
+        return result
+
+    def get_countries(self):
+        if self._countries is None:
+            url = f"{self.base_url}/countries"
+            self._countries = self._get_parsed(url, self._parse_countries)
+        return list(self._countries)
+
+    def _parse_countries(self, content):
+        tree = html.document_fromstring(content, parser=_HTML_PARSER)
         
-        europe_anchor = soup.find('a', id='europe')
-        if not europe_anchor:
+        europe_anchors = tree.xpath('//a[@id="europe"]')
+        if not europe_anchors:
             return []
         
-        countries_list = europe_anchor.find_next('ul', class_='countries-list')
-        if not countries_list:
+        countries_lists = europe_anchors[0].xpath(f'following::ul[{_has_class("countries-list")}][1]')
+        if not countries_lists:
             return []
         
         countries = []
-        for li in countries_list.find_all('li'):
-            country_link = li.find('a')
-            if country_link:
-                country_name = country_link.text.strip()
-                country_url = country_link['href']
-                countries.append({'name': country_name, 'url': country_url})
+        for country_link in countries_lists[0].xpath('.//li/a'):
+            country_name = country_link.text_content().strip()
+            country_url = country_link.get('href')
+            countries.append({'name': country_name, 'url': country_url})
         
         return countries
 
     def get_resorts_with_tabs(self, country):
+        """
+        Resorts of a country, from the main country page and all of its tabs.
+
+        The tab pages are fetched concurrently on an event loop of its own, so this cannot
+        be called from a running event loop; async code uses aget_resorts_with_tabs instead.
+        """
+        if country in self._resorts_by_country:
+            return list(self._resorts_by_country[country])
+
+        async def fetch():
+            async with self.async_session() as session:
+                return await self.aget_resorts_with_tabs(session, country)
+
+        return asyncio.run(fetch())
+
+    async def aget_resorts_with_tabs(self, session, country):
+        """Async variant of get_resorts_with_tabs, session comes from async_session()"""
+        if country in self._resorts_by_country:
+            return list(self._resorts_by_country[country])
+
         base_url = f"{self.base_url}/countries/{country}/resorts/"
-        response = requests.get(base_url)
-        response.raise_for_status()
-        soup = bs4.BeautifulSoup(response.text, 'html.parser')
 
         #  Extract resorts from the main page / first tab
-        resorts = self._extract_resorts_from_page(soup)
+        first_tab_resorts, tab_urls = await self._aget_parsed(session, base_url, self._parse_resorts_page)
+        resorts = list(first_tab_resorts)
         
-        # Check if tabs are present
-        tabs_div = soup.find('div', id='ctry_tabs')
-        if tabs_div:
-            tab_links = tabs_div.find_all('a')
-            tab_urls = [link['href'] for link in tab_links]
-
-            for tab_url in tab_urls:
-                full_tab_url = f"{self.base_url}{tab_url}"
-                tab_response = requests.get(full_tab_url)
-                tab_response.raise_for_status()
-                tab_soup = bs4.BeautifulSoup(tab_response.text, 'html.parser')
-                resorts.extend(self._extract_resorts_from_page(tab_soup))        
+        # Tabs often include one pointing back to the page already fetched ("All"),
+        # skip that one and any duplicates
+        seen_urls = {base_url.rstrip('/').lower()}
+        full_tab_urls = []
+        for tab_url in tab_urls:
+            full_tab_url = f"{self.base_url}{tab_url}"
+            url_key = full_tab_url.rstrip('/').lower()
+            if url_key not in seen_urls:
+                seen_urls.add(url_key)
+                full_tab_urls.append(full_tab_url)
 
-        return resorts
+        # Check if tabs are present, and fetch them all concurrently
+        if full_tab_urls:
+            tab_pages = await asyncio.gather(
+                *(self._aget_parsed(session, url, self._parse_resorts_page) for url in full_tab_urls))
+            for tab_resorts, _ in tab_pages:
+                resorts.extend(tab_resorts)
+
+        self._resorts_by_country[country] = resorts
+        return list(resorts)
+
+    def _parse_resorts_page(self, content):
+        """Return [resorts, tab URLs] for a country page, as a list so it round-trips through the JSON cache"""
+        tree = html.document_fromstring(content, parser=_HTML_PARSER)
+        tab_urls = [str(tab_url) for tab_url in tree.xpath('//div[@id="ctry_tabs"]//a/@href')]
+        return [self._extract_resorts_from_page(tree), tab_urls]
 
     # Method to get the coordinates of a resort
     def get_resort_coordinates(self, resort_url):
@@ -83,22 +293,27 @@ class SnowForecast:
         </div>
         """
         # Load the resort URL page
-        response = requests.get(self.base_url + resort_url)
-        response.raise_for_status()
-        soup = bs4.BeautifulSoup(response.content, 'html.parser')
+        return self._get_parsed(self.base_url + resort_url, self._parse_coordinates)
+
+    async def aget_resort_coordinates(self, session, resort_url):
+        """Async variant of get_resort_coordinates, session comes from async_session()"""
+        return await self._aget_parsed(session, self.base_url + resort_url, self._parse_coordinates)
+
+    def _parse_coordinates(self, content):
+        tree = html.document_fromstring(content, parser=_HTML_PARSER)
 
         # Find the div containing the coordinates
-        coord_div = soup.find('div', class_='location-subnavigation__location-title-text')
-        if coord_div:
-            coord_info = coord_div.find('div', class_='is-block has-text-xs')
-            if coord_info:
+        coord_divs = tree.xpath(f'//div[{_has_class("location-subnavigation__location-title-text")}]')
+        if coord_divs:
+            coord_infos = coord_divs[0].xpath(f'.//div[{_has_class("is-block")} and {_has_class("has-text-xs")}]')
+            if coord_infos:
                 # Extract latitude
-                lat_span = coord_info.find('span', class_='latitude')
+                lat_spans = coord_infos[0].xpath(f'.//span[{_has_class("latitude")}]')
                 # Extract longitude
-                lon_span = coord_info.find('span', class_='longitude')
-                if lat_span and lon_span:
-                    lat_text = lat_span.get_text(strip=True)
-                    lon_text = lon_span.get_text(strip=True)
+                lon_spans = coord_infos[0].xpath(f'.//span[{_has_class("longitude")}]')
+                if lat_spans and lon_spans:
+                    lat_text = _cell_text(lat_spans[0])
+                    lon_text = _cell_text(lon_spans[0])
 
                     # Process latitude
                     lat_value_str, lat_direction = lat_text.replace('°', '').split()
@@ -117,19 +332,20 @@ class SnowForecast:
                     return geo
         return None
     
-    def _extract_resorts_from_page(self, soup):
+    def _extract_resorts_from_page(self, tree):
         resorts = []
-        resort_rows = soup.find_all('tr', class_='digest-row')
+        resort_rows = tree.xpath(f'//tr[{_has_class("digest-row")}]')
         for row in resort_rows:
             resort_url = row.get('data-url')
-            name_cell = row.find('div', class_='name')
-            if name_cell and resort_url:
-                resort_name = name_cell.get_text(strip=True)
-                resort_a_href = name_cell.find('a')
+            name_cells = row.xpath(f'.//div[{_has_class("name")}]')
+            if name_cells and resort_url:
+                name_cell = name_cells[0]
+                resort_name = _cell_text(name_cell)
+                resort_a_href = name_cell.find('.//a')
                 resorts.append({
                     'name': resort_name,
                     'data_url': resort_url,
-                    'url': resort_a_href['href']
+                    'url': resort_a_href.get('href')
                 })
         return resorts
 
@@ -146,89 +362,104 @@ class SnowForecast:
     # Example file is example-forecast.html
     def forecast_for_resort(self, resort_url):
         full_url = f"{self.base_url}{resort_url}"
-        response = requests.get(full_url, headers=self.headers)
-        response.raise_for_status()
-        html_content = response.text
-
-        soup = bs4.BeautifulSoup(html_content, 'html.parser')
-        forecast_table = soup.find('table', class_='forecast-table__table')
-        if not forecast_table:
-            logger.error("Forecast table not found")
-            return None
-
-        # Extract dates and time slots from the header rows
-        days_row = forecast_table.find('tr', attrs={'data-row': 'days'})
-        if not days_row:
-            logger.error("Days row not found")
+        return self._get_parsed(full_url, _parse_forecast)
+
+    async def aforecast_for_resort(self, session, resort_url, executor=None):
+        """
+        Async variant of forecast_for_resort, session comes from async_session().
+        If an executor (e.g. a ProcessPoolExecutor) is given, the page is parsed in it.
+        """
+        full_url = f"{self.base_url}{resort_url}"
+        return await self._aget_parsed(session, full_url, _parse_forecast, executor)
+
+def _parse_forecast(html_content):
+    """Parse a forecast page into a list of per-period dicts; module level so it can run in a worker process"""
+    tree = html.document_fromstring(html_content, parser=_HTML_PARSER)
+    # Collect all rows of the first forecast table in one query, keyed by their data-row
+    rows = {}
+    for row in tree.xpath(f'(//table[{_has_class("forecast-table__table")}])[1]//tr[@data-row]'):
+        rows.setdefault(row.get('data-row'), row)
+    if not rows:
+        logger.error("Forecast table not found")
+        return None
+
+    # Extract dates and time slots from the header rows
+    days_row = rows.get('days')
+    if days_row is None:
+        logger.error("Days row not found")
+    else:
+        logger.info("Days row found")
+    time_row = rows.get('time')
+    if time_row is None:
+        logger.error("Time row not found")
+    else:
+        logger.info("Time row found")
+
+    date_runs = []
+    times = []
+
+    if days_row is not None and time_row is not None:
+        # Find all 'td' elements in the days row
+        day_cells = days_row.xpath(f'./td[{_has_class("forecast-table-days__cell")}]')
+        if not day_cells:
+            logger.error("Day cells not found")
         else:
-            logger.info("Days row found")
-        time_row = forecast_table.find('tr', attrs={'data-row': 'time'})
-        if not time_row:
-            logger.error("Time row not found")
+            logger.info(f"Found {len(day_cells)} day cells")
+
+        time_cells = time_row.xpath(f'./td[{_has_class("forecast-table__cell")}]')
+        if not time_cells:
+            logger.error("Time cells not found")
         else:
-            logger.info("Time row found")
-
-        dates = []
-        times = []
-
-        if days_row and time_row:
-            # Find all 'td' elements in the days row
-            day_cells = days_row.find_all('td', class_='forecast-table-days__cell')
-            if not day_cells:
-                logger.error("Day cells not found")
-            else:
-                logger.info(f"Found {len(day_cells)} day cells")
-
-            time_cells = time_row.find_all('td', class_='forecast-table__cell')
-            if not time_cells:
-                logger.error("Time cells not found")
-            else:
-                logger.info(f"Found {len(time_cells)} time cells")
-
-            # Extract dates from 'data-date' attribute and repeat according to 'colspan'
-            for day_cell in day_cells:
-                date_text = day_cell.get('data-date')
-                # Get colspan to know how many time periods this date applies to
-                colspan = int(day_cell.get('colspan', 1))
-                # Add the date multiple times based on colspan
-                dates.extend([date_text] * colspan)
-                logger.debug(f"Date {date_text} found, repeated {colspan} times")
-
-            # Extract time slots
-            for time_cell in time_cells:
-                time_text = time_cell.get_text(strip=True)
-                times.append(time_text)
-                logger.debug(f"Time slot found: {time_text}")
-
-        # Extract data rows
-        snow_row = forecast_table.find('tr', attrs={'data-row': 'snow'})
-        freezing_level_row = forecast_table.find('tr', attrs={'data-row': 'freezing-level'})
-        humidity_row = forecast_table.find('tr', attrs={'data-row': 'humidity'})
-        wind_row = forecast_table.find('tr', attrs={'data-row': 'wind'})  # Add wind row extraction
-
-        # Get the data cells
-        snow_data = [td.get_text(strip=True) for td in snow_row.find_all('td')] if snow_row else []
-        # Replace em dash '—' with '0'
-        snow_data = ['0' if cm == '—' else cm for cm in snow_data]
+            logger.info(f"Found {len(time_cells)} time cells")
+
+        # Extract dates from 'data-date' attribute, each with its 'colspan'
+        for day_cell in day_cells:
+            date_text = day_cell.get('data-date')
+            # Get colspan to know how many time periods this date applies to
+            colspan = int(day_cell.get('colspan', 1))
+            date_runs.append((date_text, colspan))
+
+        # Extract time slots
+        times = [_cell_text(time_cell) for time_cell in time_cells]
+
+        # One summary line per row instead of one per cell
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Dates found (date, repeated times): {date_runs}")
+            logger.debug(f"Time slots found: {times}")
+
+    # Extract data rows
+    snow_row = rows.get('snow')
+    freezing_level_row = rows.get('freezing-level')
+    humidity_row = rows.get('humidity')
+    wind_row = rows.get('wind')  # Add wind row extraction
+
+    # Get the data cells, a missing row reuses the empty _NO_CELLS instead of a new list
+    # Replace em dash '—' with '0' while extracting, so only one list is built
+    snow_data = [_DASH_FIX.get(cm, cm) for cm in map(_cell_text, snow_row.iterchildren('td'))] if snow_row is not None else _NO_CELLS
+    
+    freezing_level_data = [_cell_text(td) for td in freezing_level_row.iterchildren('td')] if freezing_level_row is not None else _NO_CELLS
+    humidity_data = [_cell_text(td) for td in humidity_row.iterchildren('td')] if humidity_row is not None else _NO_CELLS
+    wind_data = [_cell_text(td) for td in wind_row.iterchildren('td')] if wind_row is not None else _NO_CELLS  # Add wind data extraction
+    if logger.isEnabledFor(logging.DEBUG):
         logger.debug(f"Snow data after cleaning: {snow_data}")
-        
-        freezing_level_data = [td.get_text(strip=True) for td in freezing_level_row.find_all('td')] if freezing_level_row else []
-        humidity_data = [td.get_text(strip=True) for td in humidity_row.find_all('td')] if humidity_row else []
-        wind_data = [td.get_text(strip=True) for td in wind_row.find_all('td')] if wind_row else []  # Add wind data extraction
         logger.debug(f"Wind data: {wind_data}")
 
-        # Combine data into a list of dictionaries
-        forecast_data = []
-        total_periods = len(times)
-        for i in range(total_periods):
-            day_forecast = {
-                'date': dates[i] if i < len(dates) else None,
-                'time': times[i],
-                'snow': snow_data[i] if i < len(snow_data) else None,
-                'freezing_level': freezing_level_data[i] if i < len(freezing_level_data) else None,
-                'humidity': humidity_data[i] if i < len(humidity_data) else None,
-                'wind': wind_data[i] if i < len(wind_data) else None  # Add wind to forecast
-            }
-            forecast_data.append(day_forecast)
-
-        return forecast_data
+    # Combine data into a list of dictionaries, one per time slot;
+    # shorter rows are padded with None and longer ones cut at the number of time slots
+    forecast_data = []
+    total_periods = len(times)
+    # Each date repeated for the time periods it spans, produced lazily while zipping
+    dates = chain.from_iterable(repeat(date_text, colspan) for date_text, colspan in date_runs)
+    columns = zip_longest(dates, times, snow_data, freezing_level_data, humidity_data, wind_data)
+    for date, time_slot, snow, freezing_level, humidity, wind in islice(columns, total_periods):
+        day_forecast = {
+            'date': date,
+            'time': time_slot,
+            'snow': snow,
+            'freezing_level': freezing_level,
+            'humidity': humidity,
+            'wind': wind  # Add wind to forecast
+        }
+        forecast_data.append(day_forecast)
+
+    return forecast_data
@@ -1,30 +1,60 @@
+import asyncio
 import json
 import logging
+import multiprocessing
+import orjson
 import os
+import re
+import time
 import yaml
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
-from dataclasses import dataclass
+from elasticsearch.helpers import parallel_bulk
+from elasticsearch.serializer import OrjsonSerializer
+from dataclasses import asdict, dataclass
 from typing import List, Dict, Optional
 from SnowForecast import SnowForecast
 
-# Configure custom logger
+# Use the libyaml-backed loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Use the custom logger, configured by setup_logging()
 logger = logging.getLogger('snow_forecast_logger')
-logger.setLevel(logging.DEBUG)
-handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
 
-# File handler
-file_handler = logging.FileHandler('snow_forecast.log')
-file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
-file_handler.setFormatter(file_formatter)
-logger.addHandler(file_handler)
-logger.info('==== Starting new run ====')
+def setup_logging():
+    """Configure the custom logger, the level comes from LOG_LEVEL (default INFO).
+    Called by the script and by each forecast parse worker, not on import, so worker
+    processes that import this module do not add their handlers twice."""
+    log_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    try:
+        logger.setLevel(log_level)
+        unknown_log_level = False
+    except ValueError:
+        # A misspelled level should not stop the run before anything is logged
+        logger.setLevel(logging.INFO)
+        unknown_log_level = True
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    # File handler
+    file_handler = logging.FileHandler('snow_forecast.log')
+    file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+    file_handler.setFormatter(file_formatter)
+    logger.addHandler(file_handler)
+    if unknown_log_level:
+        logger.warning(f"Unknown LOG_LEVEL {log_level!r}, logging at INFO")
+
+# Numeric part of a snow amount such as '12', '1.5' or '12cm'
+_NUM_RE = re.compile(r'[-+]?\d*\.?\d+')
 
-@dataclass
+@dataclass(slots=True)
 class Resort:
     name: str
     country: str
@@ -32,7 +62,7 @@ class Resort:
     data_url: Optional[str] = None
     geo: Optional[Dict[str, float]] = None
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class SnowForecastDocument:
     """Represents a snow forecast document for Elasticsearch"""
     name: str
@@ -43,8 +73,29 @@ class SnowForecastDocument:
     timestamp: str  # ISO8601 date when the forecast was fetched
 
 def load_user_resorts(yaml_path: str) -> List[Resort]:
-    with open(yaml_path, 'r') as file:
-        yaml_data = yaml.safe_load(file)
+    # The parsed config is cached as JSON next to it, valid as long as the config's mtime matches
+    cache_path = f"{yaml_path}.cache.json"
+    mtime = os.path.getmtime(yaml_path)
+    yaml_data = None
+    try:
+        with open(cache_path, 'rb') as file:
+            cached = orjson.loads(file.read())
+    except (OSError, orjson.JSONDecodeError):
+        cached = None
+    # Anything but a cache written for this mtime is a miss
+    if isinstance(cached, dict) and cached.get('mtime') == mtime and isinstance(cached.get('data'), dict):
+        yaml_data = cached['data']
+
+    if yaml_data is None:
+        # Read bytes, libyaml then decodes the UTF-8 itself
+        with open(yaml_path, 'rb') as file:
+            yaml_data = yaml.load(file, Loader=SafeLoader)
+        # The cache only saves time, a config directory that cannot be written to is not an error
+        try:
+            with open(cache_path, 'wb') as file:
+                file.write(orjson.dumps({'mtime': mtime, 'data': yaml_data}))
+        except OSError as e:
+            logger.warning(f"Could not save YAML cache {cache_path}: {e}")
     
     resorts = []
     for country, resort_names in yaml_data.items():
@@ -53,73 +104,137 @@ def load_user_resorts(yaml_path: str) -> List[Resort]:
                 resorts.append(Resort(name=resort_name, country=country))
     return resorts
 
-def load_snow_forecast_resorts(countries: List[str], force_load: bool = False) -> Dict[str, List[Resort]]:
+# Resort listings change only a few times per season
+RESORTS_CACHE_TTL = 7 * 24 * 3600
+
+def load_snow_forecast_resorts(sf: SnowForecast, countries: List[str], force_load: bool = False) -> Dict[str, List[Resort]]:
+    """Resorts listed on snow-forecast.com for the given countries.
+    Listings are cached per country in an NDJSON file and only scraped again
+    when older than RESORTS_CACHE_TTL, or when force_load is set."""
     cache_file = 'snow_forecast_resorts.ndjson'
     
-    if not force_load and os.path.exists(cache_file):
-        resorts_by_country = {}
-        with open(cache_file, 'r') as f:
+    # Cached resorts and the time they were fetched, per country
+    resorts_by_country = {}
+    fetched_at = {}
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
             for line in f:
-                data = json.loads(line)
+                data = orjson.loads(line)
                 country = data['country']
-                if country not in resorts_by_country:
-                    resorts_by_country[country] = []
                 # Convert cached data directly to Resort object
-                resort = Resort(**data['resort_data'])
-                resorts_by_country[country].append(resort)
-        return resorts_by_country
+                resorts_by_country.setdefault(country, []).append(Resort(**data['resort_data']))
+                fetched_at[country] = data.get('fetched_at', 0)
 
-    sf = SnowForecast()
-    resorts_by_country = {}
-    
-    for country in countries:
-        logger.info(f"Loading resorts for {country}")
-        raw_resorts = sf.get_resorts_with_tabs(country.lower())
-        resorts = []
-        for raw_resort in raw_resorts:            
-            resort = Resort(
-                name=raw_resort['name'],
-                country=country,
-                url=raw_resort['url'],
-                data_url=raw_resort['data_url']
-            )
-            resorts.append(resort)
-        resorts_by_country[country] = resorts
-        
-        # Save complete Resort objects to NDJSON file
-        with open(cache_file, 'a') as f:
-            for resort in resorts:
-                resort_dict = {
-                    'country': country,
-                    'resort_data': {
-                        'name': resort.name,
-                        'country': resort.country,
-                        'url': resort.url,
-                        'data_url': resort.data_url
-                    }
-                }
-                json.dump(resort_dict, f)
-                f.write('\n')
+    now = time.time()
+    stale_countries = [
+        country for country in countries
+        if force_load or country not in resorts_by_country or now - fetched_at[country] > RESORTS_CACHE_TTL
+    ]
+    if stale_countries:
+        for country in stale_countries:
+            logger.info(f"Loading resorts for {country}")
+            raw_resorts = sf.get_resorts_with_tabs(country.lower())
+            # The scraped dicts carry exactly the name, url and data_url fields of Resort
+            resorts_by_country[country] = [Resort(country=country, **raw_resort) for raw_resort in raw_resorts]
+            fetched_at[country] = now
+
+        # Save complete Resort objects of all cached countries to the NDJSON file
+        with open(cache_file, 'wb') as f:
+            for country, resorts in resorts_by_country.items():
+                for resort in resorts:
+                    resort_dict = {'country': country, 'fetched_at': fetched_at[country], 'resort_data': resort}
+                    f.write(orjson.dumps(resort_dict) + b'\n')
     
-    return resorts_by_country
+    return {country: resorts_by_country[country] for country in countries}
 
 def update_user_resorts(user_resorts: List[Resort], snow_forecast_resorts: Dict[str, List[Resort]]):
+    # Lowercase every resort name once, instead of on every comparison
+    lowered_by_country = {
+        country: [(sf_resort.name.lower(), sf_resort) for sf_resort in country_resorts]
+        for country, country_resorts in snow_forecast_resorts.items()
+    }
+    # Index resorts by lowercase name; on duplicate names the first listed resort wins
+    resorts_by_name = {
+        country: dict(reversed(lowered))
+        for country, lowered in lowered_by_country.items()
+    }
+    # Join each country's lowercase names into one string so the substring fallback is a
+    # single str.find; the start offset of each name maps a match back to its resort
+    search_by_country = {}
+    for country, lowered in lowered_by_country.items():
+        offsets = []
+        position = 0
+        for sf_name_lower, _ in lowered:
+            offsets.append(position)
+            position += len(sf_name_lower) + 1
+        haystack = '\n'.join(sf_name_lower for sf_name_lower, _ in lowered)
+        search_by_country[country] = (haystack, offsets, [sf_resort for _, sf_resort in lowered])
+
     for user_resort in user_resorts:
-        country_resorts = snow_forecast_resorts.get(user_resort.country, [])
-        for sf_resort in country_resorts:
-            if user_resort.name.lower() in sf_resort.name.lower():
-                user_resort.url = sf_resort.url
-                user_resort.data_url = sf_resort.data_url
-                break
+        user_name_lower = user_resort.name.lower()
+        # Prefer an exact name match, fall back to the first resort containing the name
+        match = resorts_by_name.get(user_resort.country, {}).get(user_name_lower)
+        if match is None and user_resort.country in search_by_country:
+            haystack, offsets, country_resorts = search_by_country[user_resort.country]
+            position = haystack.find(user_name_lower)
+            if position != -1 and offsets:
+                match = country_resorts[bisect_right(offsets, position) - 1]
+        if match is not None:
+            user_resort.url = match.url
+            user_resort.data_url = match.data_url
+
+async def gather_coordinates(sf: SnowForecast, resorts: List[Resort], max_concurrency: int = 8) -> List:
+    """Fetch the coordinates of all resorts concurrently, at most max_concurrency at a time.
+    Returns the geo dict (or the raised exception) per resort, in order."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(session, resort):
+        async with semaphore:
+            return await sf.aget_resort_coordinates(session, resort.url)
+
+    async with sf.async_session() as session:
+        return await asyncio.gather(*(fetch(session, resort) for resort in resorts), return_exceptions=True)
+
+def create_parse_pool(resort_count: int, max_concurrency: int = 8) -> Optional[ProcessPoolExecutor]:
+    """Process pool for parsing forecast pages, or None when parsing in this process is cheaper.
+    Create it before starting the event loop and shut it down when done."""
+    # At most max_concurrency pages are parsed at once, so more workers than that would sit idle,
+    # and for a single resort starting a pool costs more than parsing in this process
+    workers = min(os.cpu_count() or 1, max_concurrency, resort_count)
+    if workers < 2:
+        return None
+    # Workers are started on the first submit, from inside the event loop where aiohttp's resolver
+    # threads already run; forking there is unsafe, so fork them from a single-threaded forkserver
+    # where available (spawn elsewhere)
+    mp_context = None
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context('forkserver')
+    return ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=setup_logging)
+
+async def gather_forecasts(sf: SnowForecast, resorts: List[Resort], max_concurrency: int = 8,
+                           executor: Optional[ProcessPoolExecutor] = None) -> List:
+    """Fetch the forecasts of all resorts concurrently, at most max_concurrency at a time.
+    Pages are parsed in executor if given (see create_parse_pool), so parsing runs on all cores
+    while other pages download.
+    Returns the forecast data (or the raised exception) per resort, in order."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(session, resort):
+        async with semaphore:
+            logger.info(f"Fetching forecast for {resort.name}, data URL: {resort.data_url}")
+            return await sf.aforecast_for_resort(session, resort.data_url, executor)
+
+    async with sf.async_session() as session:
+        return await asyncio.gather(*(fetch(session, resort) for resort in resorts), return_exceptions=True)
 
 def create_snow_forecast_document(resort: Resort, forecast_data: List[Dict]) -> SnowForecastDocument:
     """Create a SnowForecastDocument from resort and its forecast data"""
     # Calculate total snow from forecast data
-    total_snow = sum(
-        float(point['snow'].replace('cm', '0')) 
-        for point in forecast_data 
-        if point.get('snow')
-    )
+    total_snow = 0.0
+    for point in forecast_data:
+        match = _NUM_RE.search(point.get('snow') or '')
+        if match:
+            total_snow += float(match.group())
     
     return SnowForecastDocument(
         name=resort.name,
@@ -136,7 +251,9 @@ def create_es_client():
         ['https://192.168.10.150:30920'],
         basic_auth=('elastic', 'ox2UYL4cj90p19q63nm6gA8b'),
         verify_certs=False,
-        ssl_show_warn=False
+        ssl_show_warn=False,
+        # orjson also encodes every bulk action and document
+        serializer=OrjsonSerializer()
     )
 
 def setup_index(es_client, index_name='snow-forecast'):
@@ -172,93 +289,103 @@ def prepare_documents(elastic_documents, index_name='snow-forecast'):
         yield doc_dict
             
 if __name__ == '__main__':
+    setup_logging()
+    logger.info('==== Starting new run ====')
     user_resorts_file = 'user_resorts.json'
     yaml_resorts = load_user_resorts('resorts.yaml')
     reload_needed = True
-    sf = SnowForecast()
-
-    if os.path.exists(user_resorts_file) and os.path.getsize(user_resorts_file) > 0:
-        # Load existing user resorts from JSON
-        with open(user_resorts_file, 'r') as f:
-            user_resorts_data = json.load(f)
-            loaded_resorts = [Resort(**data) for data in user_resorts_data]
+    # Closing the client also saves the parsed page cache, even when a step below fails
+    with SnowForecast() as sf:
+        if os.path.exists(user_resorts_file) and os.path.getsize(user_resorts_file) > 0:
+            # Load existing user resorts from JSON
+            with open(user_resorts_file, 'r') as f:
+                user_resorts_data = json.load(f)
+                loaded_resorts = [Resort(**data) for data in user_resorts_data]
             
-        # Compare loaded resorts with yaml resorts
-        if len(loaded_resorts) == len(yaml_resorts):
-            yaml_resort_keys = {(r.name, r.country) for r in yaml_resorts}
-            loaded_resort_keys = {(r.name, r.country) for r in loaded_resorts}
-            if yaml_resort_keys == loaded_resort_keys:
-                user_resorts = loaded_resorts
-                reload_needed = False
-                logger.info(f"Loaded {len(user_resorts)} matching resort(s) from {user_resorts_file}")
+            # Compare loaded resorts with yaml resorts
+            if len(loaded_resorts) == len(yaml_resorts):
+                yaml_resort_keys = {(r.name, r.country) for r in yaml_resorts}
+                loaded_resort_keys = {(r.name, r.country) for r in loaded_resorts}
+                if yaml_resort_keys == loaded_resort_keys:
+                    user_resorts = loaded_resorts
+                    reload_needed = False
+                    logger.info(f"Loaded {len(user_resorts)} matching resort(s) from {user_resorts_file}")
     
-    if reload_needed:
-        # Perform the original scraping and data collection
-        user_resorts = yaml_resorts
-        logger.info(f"User resorts: {user_resorts}")
-        unique_countries = list(set(resort.country for resort in user_resorts))
-        snow_forecast_resorts = load_snow_forecast_resorts(unique_countries, True)
-        logger.debug(f"Snow forecast resorts: {snow_forecast_resorts}")
-        update_user_resorts(user_resorts, snow_forecast_resorts)
+        if reload_needed:
+            # Perform the original scraping and data collection
+            user_resorts = yaml_resorts
+            logger.info(f"User resorts: {user_resorts}")
+            unique_countries = list(set(resort.country for resort in user_resorts))
+            snow_forecast_resorts = load_snow_forecast_resorts(sf, unique_countries)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Snow forecast resorts: {snow_forecast_resorts}")
+            update_user_resorts(user_resorts, snow_forecast_resorts)
         
-        # Add geo coordinates to user resorts
-        for user_resort in user_resorts:
-            if user_resort.url:
-                user_resort.geo = sf.get_resort_coordinates(user_resort.url)
-                logger.info(f"Added geo coordinates for {user_resort.name}: {user_resort.geo}")
+            # Add geo coordinates to user resorts
+            resorts_with_url = [user_resort for user_resort in user_resorts if user_resort.url]
+            coordinates = asyncio.run(gather_coordinates(sf, resorts_with_url))
+            for user_resort, geo in zip(resorts_with_url, coordinates):
+                if isinstance(geo, Exception):
+                    logger.error(f"Failed to fetch coordinates for {user_resort.name}: {geo}")
+                else:
+                    user_resort.geo = geo
+                    logger.info(f"Added geo coordinates for {user_resort.name}: {user_resort.geo}")
                 
-        # Save the updated resorts
-        with open(user_resorts_file, 'w') as f:
-            json.dump([resort.__dict__ for resort in user_resorts], f, indent=4)
+            # Save the updated resorts
+            with open(user_resorts_file, 'w') as f:
+                json.dump([asdict(resort) for resort in user_resorts], f, indent=4)
             
-    # Fetch snow forecast data for each resort
-    logger.info("Fetching snow forecast data for resorts...")
-    elastic_documents = []
-    for resort in user_resorts:
-        if resort.data_url:
-            logger.info(f"Fetching forecast for {resort.name}, data URL: {resort.data_url}")
-            forecast_data = sf.forecast_for_resort(resort.data_url)
-            if forecast_data:
-                doc = create_snow_forecast_document(resort, forecast_data)
-                elastic_documents.append(doc)
-                logger.info(f"Successfully created document for {resort.name}")
-            else:
-                logger.error(f"Failed to fetch forecast for {resort.name}")
+        # Fetch snow forecast data for each resort
+        logger.info("Fetching snow forecast data for resorts...")
+        elastic_documents = []
+        resorts_with_data = [resort for resort in user_resorts if resort.data_url]
+        executor = create_parse_pool(len(resorts_with_data))
+        try:
+            results = asyncio.run(gather_forecasts(sf, resorts_with_data, executor=executor))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    for resort, forecast_data in zip(resorts_with_data, results):
+        if isinstance(forecast_data, Exception):
+            logger.error(f"Failed to fetch forecast for {resort.name}: {forecast_data}")
+        elif forecast_data:
+            doc = create_snow_forecast_document(resort, forecast_data)
+            elastic_documents.append(doc)
+            logger.info(f"Successfully created document for {resort.name}")
+        else:
+            logger.error(f"Failed to fetch forecast for {resort.name}")
     
     logger.info(f"Created {len(elastic_documents)} documents ready for Elasticsearch")
-    for doc in elastic_documents:
-        logger.debug(f"Document: {json.dumps(doc.__dict__)}")
     
-    with open('sample.json', 'w') as f:
+    # orjson serializes the dataclasses directly, without an asdict() copy,
+    # and each document is encoded once for both the debug log and the sample file
+    action_line = orjson.dumps({"index": {"_index": "snow-forecasts"}})
+    with open('sample.json', 'wb') as f:
         for doc in elastic_documents:
-            # Write the action line
-            action = {"index": {"_index": "snow-forecasts"}}
-            json.dump(action, f)
-            f.write('\n')
-            # Write the document line
-            json.dump(doc.__dict__, f)
-            f.write('\n')
+            doc_line = orjson.dumps(doc)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Document: {doc_line.decode()}")
+            # Write the action line and the document line
+            f.write(action_line + b'\n' + doc_line + b'\n')
     # After creating elastic_documents, send to Elasticsearch
     try:
         es = create_es_client()
         setup_index(es)
         
-        # Prepare documents first
-        documents = list(prepare_documents(elastic_documents,'snow-forecast'))
-        
-        # Try to bulk index
-        try:
-            success, errors = bulk(es, documents, stats_only=False)
-            logger.info(f"Successfully indexed {success} documents")
-        except Exception as bulk_error:
-            if hasattr(bulk_error, 'errors'):
-                logger.error("Bulk indexing errors:")
-                for error in bulk_error.errors:
-                    if 'index' in error and 'error' in error['index']:
-                        logger.error(f"Document error: {error['index']['error']}")
-                        logger.error(f"Document ID: {error['index']['_id']}")
-                        logger.error(f"Status: {error['index']['status']}")
-            raise
+        # Stream the documents to Elasticsearch in chunks of up to 500 docs / 10 MB,
+        # sent from several threads so chunks are indexed while the next ones are sent
+        success = 0
+        for ok, result in parallel_bulk(es, prepare_documents(elastic_documents, 'snow-forecast'),
+                                        thread_count=4, chunk_size=500,
+                                        max_chunk_bytes=10 * 1024 * 1024,
+                                        raise_on_error=False):
+            if ok:
+                success += 1
+            elif 'index' in result and 'error' in result['index']:
+                logger.error(f"Document error: {result['index']['error']}")
+                logger.error(f"Document ID: {result['index'].get('_id')}")
+                logger.error(f"Status: {result['index'].get('status')}")
+        logger.info(f"Successfully indexed {success} documents")
             
     except Exception as e:
         logger.error(f"Error connecting to Elasticsearch: {str(e)}", exc_info=True)